@@ -82,6 +82,24 @@ def hash_pkg(*, pkgpath):
     return hashlib.sha1('blob {}\0{}'.format(len(details), details).encode()).hexdigest()
 
 
+def hash_file(*, filepath, chunk_size=65536):
+    """
+    Streaming SHA1 hash of a file's bytes (same as git: git hash-object <filepath>).
+
+    :param filepath: Path to file to hash
+    :type filepath: str
+    :param chunk_size: Bytes to read at a time, defaults to 65536
+    :type chunk_size: int, optional
+    :return: Hex digest of the file contents
+    :rtype: str
+    """
+    with open(filepath, 'rb') as f:
+        digest = hashlib.sha1('blob {}\0'.format(os.fstat(f.fileno()).st_size).encode())
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
 def _update_details_dir(*, dirpath, refpath, details):
     paths = sorted(pathlib.Path(dirpath).absolute().glob('*'))
     # walk a directory to collect info
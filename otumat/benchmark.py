@@ -0,0 +1,125 @@
+"""Load-test harness for the usage data upload pipeline."""
+import os
+import json
+import uuid
+import time
+import array
+import shutil
+import pathlib
+import appdirs
+from .mock import MockIngestServer
+from . import usage
+
+try:
+    import resource
+except ImportError:
+    # not available on Windows
+    resource = None
+
+BENCHMARK_SEGMENT_INTERVAL = 0.05
+
+
+def run(*, events: int = 100000, send_every: int = 10000, expire_every: int = 0,
+        multi_writer: bool = False, bulk: int = 0):
+    """
+    Drives `UsageAgent.log` (or `UsageAgent.log_many`) and timed `UsageAgent.send` cycles
+    against a local `MockIngestServer` using a throwaway data directory.
+
+    :param events: Number of events to log, defaults to 100000
+    :type events: int, optional
+    :param send_every: Number of events logged between send cycles, defaults to 10000
+    :type send_every: int, optional
+    :param expire_every: Reject every nth upload as expired to exercise token renewal,
+        defaults to never
+    :type expire_every: int, optional
+    :param multi_writer: Log to segment files instead of the cache directly, defaults to
+        False
+    :type multi_writer: bool, optional
+    :param bulk: Log with `log_many` in batches of this many events, defaults to using `log`
+    :type bulk: int, optional
+    :return: Benchmark results, latencies are per logging call
+    :rtype: dict
+    """
+    if send_every < 1 or events < 0 or bulk < 0 or expire_every < 0:
+        raise Exception('`send_every` must be positive and `events`, `bulk`, and '
+                        '`expire_every` must not be negative.')
+    author = 'otumat'
+    data_directory = f'otumat-benchmark-{uuid.uuid4().hex[:8]}'
+    package_name = 'otumat-benchmark'
+    data_path = pathlib.Path(appdirs.user_data_dir(data_directory, author))
+    with MockIngestServer(expire_every=expire_every) as server:
+        try:
+            # pre-seed an installed configuration to bypass the consent flow
+            os.makedirs(pathlib.Path(data_path, 'usage'))
+            pathlib.Path(data_path, 'usage', 'config.json').write_text(json.dumps(dict(
+                author=author, data_directory=data_directory, package_name=package_name,
+                host=server.url, install_route=None, event_route=server.event_route,
+                refresh_route=server.refresh_route, response_timeout=60,
+                upload_frequency='24h', prometheus=False, collect=True, access_token=None,
+                refresh_token=server.refresh_token, expires_at=None, scope=None,
+                install_id=server.install_id, client_id=server.client_id,
+                client_secret=server.client_secret)))
+            # seal segments quickly so they are merged by the following send cycle
+            agent = usage.UsageAgent(author=author, data_directory=data_directory,
+                                     package_name=package_name, multi_writer=multi_writer,
+                                     segment_interval=BENCHMARK_SEGMENT_INTERVAL)
+            agent.create_cache()
+            latencies = array.array('d')
+            send_seconds = 0
+            sends = 0
+
+            def send():
+                nonlocal send_seconds, sends
+                if multi_writer:
+                    # wait for the current segment to seal, not counted as send time
+                    time.sleep(2 * BENCHMARK_SEGMENT_INTERVAL)
+                send_start = time.perf_counter()
+                agent.send()
+                send_seconds += time.perf_counter() - send_start
+                sends += 1
+
+            start = time.perf_counter()
+            logged = 0
+            while logged < events:
+                # never log across a send cycle boundary
+                count = min(bulk or 1, events - logged, send_every - logged % send_every)
+                log_start = time.perf_counter()
+                if bulk:
+                    agent.log_many((None, f'event{(logged + i) % 10}') for i in range(count))
+                else:
+                    agent.log(event_type=f'event{logged % 10}')
+                latencies.append(time.perf_counter() - log_start)
+                logged += count
+                if logged % send_every == 0:
+                    send()
+            if events % send_every or not events:
+                send()
+            total_seconds = time.perf_counter() - start
+            agent.flush_metrics()
+            agent_metrics = agent.show_metrics()
+        finally:
+            shutil.rmtree(data_path, ignore_errors=True)
+    latencies = sorted(latencies)
+    log_seconds = sum(latencies)
+    return dict(
+        events=events,
+        total_seconds=total_seconds,
+        mode=' '.join(['log_many' if bulk else 'log'] +
+                      (['multi_writer'] if multi_writer else [])),
+        events_per_call=bulk or 1,
+        log_events_per_second=events / log_seconds if log_seconds else None,
+        log_p50_us=latencies[len(latencies) // 2] * 1e6 if latencies else None,
+        log_p99_us=latencies[int(len(latencies) * 0.99)] * 1e6 if latencies else None,
+        log_max_us=latencies[-1] * 1e6 if latencies else None,
+        sends=sends,
+        send_seconds=send_seconds,
+        events_uploaded=server.stats['events_received'],
+        upload_events_per_second=(server.stats['events_received'] / send_seconds
+                                  if send_seconds else None),
+        upload_bytes_per_second=(server.stats['bytes_received'] / send_seconds
+                                 if send_seconds else None),
+        token_refreshes=server.stats['refreshes'],
+        token_expired_retries=agent_metrics.get('send_retries_total', (None, 0))[1],
+        peak_rss_mb=(None if resource is None else
+                     resource.getrusage(resource.RUSAGE_SELF).ru_maxrss /
+                     (1024 * 1024 if os.uname().sysname == 'Darwin' else 1024)))
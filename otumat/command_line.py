@@ -2,7 +2,11 @@ import argparse
 from . import __version__ as version
 from . import usage as otumat_usage
 from . import watch as otumat_watch
+from . import metrics as otumat_metrics
 import datetime
+import pathlib
+import json
+import appdirs
 
 
 def otumat(args=None):
@@ -47,6 +51,68 @@ def otumat(args=None):
                                 dest='frequency',
                                 help='Schedule to send usage data e.g. 30s|1m|15m|1h|12h.')
 
+    parser_stats = subparsers.add_parser('stats',
+                                         description='Show usage agent metrics.')
+    required_named = parser_stats.add_argument_group('required named arguments')
+    optional_named = parser_stats.add_argument_group('optional named arguments')
+
+    required_named.add_argument('-a', '--author',
+                                type=str,
+                                required=True,
+                                dest='author',
+                                help='Author of package which to collect usage data.')
+    required_named.add_argument('-d', '--data-directory',
+                                type=str,
+                                required=True,
+                                dest='data_directory',
+                                help='Directory name for usage data home.')
+    required_named.add_argument('-p', '--package-name',
+                                type=str,
+                                required=True,
+                                dest='package_name',
+                                help='Name of package which to collect usage data.')
+    optional_named.add_argument('--prometheus',
+                                action='store_true',
+                                dest='prometheus',
+                                help='Output in Prometheus text format.')
+
+    parser_benchmark = subparsers.add_parser(
+        'benchmark',
+        description='Load-test usage data logging and upload against a local mock server.')
+    optional_named = parser_benchmark.add_argument_group('optional named arguments')
+
+    optional_named.add_argument('-n', '--events',
+                                type=_non_negative_int,
+                                required=False,
+                                default=100000,
+                                dest='events',
+                                help='Number of events to log. Defaults to 100000.')
+    optional_named.add_argument('-b', '--send-every',
+                                type=_positive_int,
+                                required=False,
+                                default=10000,
+                                dest='send_every',
+                                help='Number of events logged between send cycles. \
+                                      Defaults to 10000.')
+    optional_named.add_argument('-e', '--expire-every',
+                                type=_non_negative_int,
+                                required=False,
+                                default=0,
+                                dest='expire_every',
+                                help='Reject every nth upload as expired to exercise token \
+                                      renewal. Defaults to never.')
+    optional_named.add_argument('-m', '--multi-writer',
+                                action='store_true',
+                                dest='multi_writer',
+                                help='Log to per-process segment files.')
+    optional_named.add_argument('-k', '--bulk',
+                                type=_positive_int,
+                                required=False,
+                                default=0,
+                                dest='bulk',
+                                help='Log with `log_many` in batches of this many events. \
+                                      Defaults to logging one event per `log` call.')
+
     parser_watch = subparsers.add_parser(
         'watch',
         description='Watch file for changes and run job on change.')
@@ -55,21 +121,47 @@ def otumat(args=None):
 
     required_named.add_argument('-f', '--file',
                                 type=str,
-                                required=True,
+                                action='append',
                                 dest='watch_file',
-                                help='Path to file to be watched.')
+                                help='Path to file or directory to be watched. May be \
+                                      repeated. Required unless --config is provided.')
     optional_named.add_argument('-i', '--interval',
                                 type=int,
                                 required=False,
-                                default=5,
+                                default=None,
                                 dest='watch_interval',
-                                help='Interval between polls in seconds. \
-                                      Defaults to 5 seconds.')
+                                help='Interval between polls in seconds. Defaults to the \
+                                      spec interval or else 5 seconds.')
     required_named.add_argument('-s', '--script',
                                 type=str,
-                                required=True,
                                 dest='watch_script',
-                                help='Script to run on file change.')
+                                help='Script to run on file change. \
+                                      Required unless --config is provided.')
+    optional_named.add_argument('--include',
+                                type=str,
+                                action='append',
+                                default=[],
+                                dest='watch_include',
+                                help='Glob pattern of paths that trigger the script. May be \
+                                      repeated. Defaults to all paths.')
+    optional_named.add_argument('--exclude',
+                                type=str,
+                                action='append',
+                                default=[],
+                                dest='watch_exclude',
+                                help='Glob pattern of paths that never trigger the script. \
+                                      May be repeated.')
+    optional_named.add_argument('--digest',
+                                action='store_true',
+                                dest='watch_digest',
+                                help='Only run script when file content changes, ignoring \
+                                      touches and identical rewrites.')
+    optional_named.add_argument('-c', '--config',
+                                type=str,
+                                required=False,
+                                dest='watch_spec',
+                                help='Path to JSON/YAML spec mapping paths and globs to \
+                                      scripts.')
     optional_named.add_argument('watch_args',
                                 nargs='*',
                                 type=str,
@@ -84,9 +176,47 @@ def otumat(args=None):
                                    if k not in ('start', 'frequency')}).recurring_send(**{
                                         k: v for k, v in kwargs.items()
                                         if k in ('start', 'frequency')})
+    elif command == 'stats':
+        # read-only, never instantiate an agent as that may trigger the installation flow
+        home_path = pathlib.Path(appdirs.user_data_dir(kwargs['data_directory'],
+                                                       kwargs['author']), 'usage')
+        try:
+            collect = json.loads(
+                pathlib.Path(home_path, 'config.json').read_text()).get('collect')
+        except FileNotFoundError:
+            print(f"Usage agent for `{kwargs['package_name']}` is not installed.")
+            raise SystemExit(1)
+        agent_metrics = (otumat_metrics.load(db_path=str(pathlib.Path(home_path, 'main.db')))
+                         if collect else None)
+        if agent_metrics is None:
+            print('Usage data collection is disabled.')
+        elif kwargs['prometheus']:
+            print(otumat_metrics.to_prometheus(metrics=agent_metrics), end='')
+        else:
+            for name, (_, value) in agent_metrics.items():
+                print(f'{name}: {value}')
+    elif command == 'benchmark':
+        from . import benchmark as otumat_benchmark
+        for name, value in otumat_benchmark.run(**kwargs).items():
+            print(f'{name}: {value}')
     elif command == 'watch':
-        otumat_watch.WatchAgent(watch_file=kwargs['watch_file'],
-                                watch_interval=kwargs['watch_interval'],
-                                watch_script=kwargs['watch_script'],
-                                watch_args=kwargs['watch_args']).run()
+        if kwargs['watch_spec'] is None and not (kwargs['watch_file'] and
+                                                 kwargs['watch_script']):
+            parser_watch.error('the following arguments are required: -f/--file, '
+                               '-s/--script (or -c/--config)')
+        elif bool(kwargs['watch_file']) != bool(kwargs['watch_script']):
+            parser_watch.error('-f/--file and -s/--script must be provided together')
+        otumat_watch.WatchAgent(**kwargs).run()
     raise SystemExit
+
+
+def _positive_int(value):
+    if not value.isdigit() or int(value) < 1:
+        raise argparse.ArgumentTypeError(f'expected a positive integer, got `{value}`')
+    return int(value)
+
+
+def _non_negative_int(value):
+    if not value.isdigit():
+        raise argparse.ArgumentTypeError(f'expected a non-negative integer, got `{value}`')
+    return int(value)
@@ -0,0 +1,132 @@
+"""Library for crash-safe configuration storage."""
+import os
+import json
+import pathlib
+import threading
+import inspect
+import weakref
+
+_stores = {}
+_stores_lock = threading.Lock()
+
+
+class ConfigStore:
+    """
+    JSON configuration file with atomic writes and an in-memory cache. Reads only reparse the
+    file when its modification time, size, or inode changes, so frequent reads are
+    essentially free and never observe a partially written file.
+    """
+    def __init__(self, path: str):
+        """
+        Instantiates a configuration store. Prefer `get_store` to share a store within a
+        process.
+
+        :param path: Path to JSON configuration file
+        :type path: str
+        """
+        self.path = pathlib.Path(path)
+        self.config = None
+        self.signature = None
+        self.subscribers = []
+        self._lock = threading.Lock()
+
+    def _stat(self):
+        stat = os.stat(self.path)
+        return (stat.st_mtime_ns, stat.st_size, stat.st_ino)
+
+    def load(self):
+        """
+        Load the configuration, reusing the cached copy if the file is unchanged. Subscribers
+        are notified if the file was changed by another writer.
+
+        :return: Configuration, treat as read-only
+        :rtype: dict
+        """
+        signature = self._stat()
+        if signature == self.signature:
+            return self.config
+        try:
+            config = json.loads(self.path.read_text())
+        except json.JSONDecodeError:
+            if self.config is None:
+                raise
+            # written in place by an older writer, keep the last consistent copy
+            return self.config
+        with self._lock:
+            changed = self.config is not None and config != self.config
+            self.config = config
+            self.signature = signature
+        if changed:
+            self._notify()
+        return config
+
+    def save(self, config: dict):
+        """
+        Atomically replace the configuration file and notify subscribers.
+
+        :param config: Configuration to save
+        :type config: dict
+        """
+        tmp_path = self.path.with_name(
+            f'.{self.path.name}.{os.getpid()}.{threading.get_ident()}.tmp')
+        try:
+            with open(tmp_path, 'w') as f:
+                json.dump(config, f, indent=4, sort_keys=True)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            # e.g. disk full or an unserializable value
+            tmp_path.unlink(missing_ok=True)
+            raise
+        with self._lock:
+            self.config = json.loads(json.dumps(config))
+            self.signature = self._stat()
+        self._notify()
+
+    def subscribe(self, callback):
+        """
+        Register a callback invoked with the new configuration whenever it changes. Bound
+        methods are referenced weakly so subscribing does not keep their object alive.
+
+        :param callback: Function accepting the configuration dict
+        :type callback: callable
+        """
+        with self._lock:
+            self.subscribers.append(weakref.WeakMethod(callback) if inspect.ismethod(callback)
+                                    else lambda: callback)
+
+    def unsubscribe(self, callback):
+        """
+        Remove a previously registered callback.
+
+        :param callback: Function previously passed to `subscribe`
+        :type callback: callable
+        """
+        with self._lock:
+            self.subscribers = [r for r in self.subscribers if r() not in (None, callback)]
+
+    def _notify(self):
+        with self._lock:
+            # drop callbacks whose objects have been garbage collected
+            self.subscribers = [r for r in self.subscribers if r() is not None]
+            callbacks = [r() for r in self.subscribers]
+        for callback in callbacks:
+            if callback is not None:
+                callback(self.config)
+
+
+def get_store(path: str):
+    """
+    Get the configuration store shared by everything in this process using `path`.
+
+    :param path: Path to JSON configuration file
+    :type path: str
+    :return: Shared configuration store
+    :rtype: ConfigStore
+    """
+    key = os.path.abspath(path)
+    with _stores_lock:
+        if key not in _stores:
+            _stores[key] = ConfigStore(key)
+        return _stores[key]
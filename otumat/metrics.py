@@ -0,0 +1,157 @@
+"""Library for usage agent self-instrumentation."""
+import os
+import contextlib
+import sqlite3
+import pathlib
+import weakref
+
+# registries are referenced weakly so they can be garbage collected
+_registries = weakref.WeakSet()
+
+
+class Metrics:
+    """
+    In-process registry of counters, gauges, and summaries. Updates are kept in memory and
+    periodically flushed to a `metric` table so totals accumulate across processes.
+    """
+    def __init__(self):
+        self.values = {}
+        _registries.add(self)
+
+    def reset(self):
+        """
+        Discard all in-memory values.
+        """
+        self.values = {}
+
+    def increment(self, name: str, value: float = 1):
+        """
+        Increment a counter.
+
+        :param name: Metric name
+        :type name: str
+        :param value: Amount to increment by, defaults to 1
+        :type value: float, optional
+        """
+        kind, current = self.values.get(name, ('counter', 0))
+        self.values[name] = (kind, current + value)
+
+    def gauge(self, name: str, value: float):
+        """
+        Set a gauge to its latest value.
+
+        :param name: Metric name
+        :type name: str
+        :param value: Current value
+        :type value: float
+        """
+        self.values[name] = ('gauge', value)
+
+    def observe(self, name: str, value: float):
+        """
+        Record an observation in a summary, tracked as `_count`, `_sum`, and `_max`.
+
+        :param name: Metric name
+        :type name: str
+        :param value: Observed value e.g. latency in seconds
+        :type value: float
+        """
+        self.increment(f'{name}_count')
+        self.increment(f'{name}_sum', value)
+        _, current = self.values.get(f'{name}_max', ('max', value))
+        self.values[f'{name}_max'] = ('max', max(current, value))
+
+    def flush(self, *, db_path: str):
+        """
+        Accumulate in-memory values into the metrics table and reset them.
+
+        :param db_path: Path to SQLite database
+        :type db_path: str
+        """
+        if not self.values:
+            return
+        values, self.values = self.values, {}
+        with contextlib.closing(sqlite3.connect(db_path)) as conn:
+            with conn:
+                _create_table(conn=conn)
+                conn.executemany("""
+                    INSERT INTO metric VALUES (?, ?, ?)
+                    ON CONFLICT(name) DO UPDATE SET kind = excluded.kind, value = CASE
+                        WHEN excluded.kind = 'counter' THEN value + excluded.value
+                        WHEN excluded.kind = 'max' THEN max(value, excluded.value)
+                        ELSE excluded.value END
+                    """, [(name, kind, value) for name, (kind, value) in values.items()])
+
+
+def _reset_registries():
+    # forked children must not re-flush values already owned by their parent
+    for registry in list(_registries):
+        registry.reset()
+
+
+if hasattr(os, 'register_at_fork'):
+    os.register_at_fork(after_in_child=_reset_registries)
+
+
+def load(*, db_path: str):
+    """
+    Load accumulated metrics.
+
+    :param db_path: Path to SQLite database
+    :type db_path: str
+    :return: Metric kind and value by metric name
+    :rtype: dict
+    """
+    if not pathlib.Path(db_path).is_file():
+        return {}
+    with contextlib.closing(sqlite3.connect(db_path)) as conn:
+        with conn:
+            _create_table(conn=conn)
+            return {name: (kind, value) for name, kind, value in conn.execute(
+                'SELECT name, kind, value FROM metric ORDER BY name')}
+
+
+def to_prometheus(*, metrics: dict, prefix: str = 'otumat_usage'):
+    """
+    Format metrics using the Prometheus text exposition format.
+
+    :param metrics: Metric kind and value by metric name
+    :type metrics: dict
+    :param prefix: Prefix prepended to every metric name, defaults to 'otumat_usage'
+    :type prefix: str, optional
+    :return: Prometheus text
+    :rtype: str
+    """
+    lines = []
+    for name, (kind, value) in sorted(metrics.items()):
+        lines.append(f'# TYPE {prefix}_{name} '
+                     f"{'counter' if kind == 'counter' else 'gauge'}")
+        lines.append(f'{prefix}_{name} {value}')
+    return ''.join(f'{line}\n' for line in lines)
+
+
+def write_prometheus(*, metrics: dict, path: str, prefix: str = 'otumat_usage'):
+    """
+    Atomically write metrics as a Prometheus text file e.g. for the node exporter's textfile
+    collector.
+
+    :param metrics: Metric kind and value by metric name
+    :type metrics: dict
+    :param path: Destination file path
+    :type path: str
+    :param prefix: Prefix prepended to every metric name, defaults to 'otumat_usage'
+    :type prefix: str, optional
+    """
+    tmp_path = pathlib.Path(f'{path}.{os.getpid()}.tmp')
+    tmp_path.write_text(to_prometheus(metrics=metrics, prefix=prefix))
+    os.replace(tmp_path, path)
+
+
+def _create_table(*, conn):
+    conn.execute("""
+    CREATE TABLE IF NOT EXISTS metric(
+        name varchar(100) PRIMARY KEY,
+        kind varchar(10),
+        value double
+    )
+    """)
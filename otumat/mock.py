@@ -0,0 +1,158 @@
+"""Local stand-in for a usage data ingestion host."""
+import json
+import uuid
+import time
+import base64
+import threading
+import urllib.parse
+import http.server
+
+
+class MockIngestServer:
+    """
+    Local HTTP server implementing the token refresh and event ingestion routes expected by
+    `UsageAgent`, for testing and benchmarking the upload pipeline without a live host.
+    """
+    def __init__(self, *, host: str = '127.0.0.1', port: int = 0,
+                 refresh_route: str = '/auth/token', event_route: str = '/api/usage-event',
+                 client_id: str = 'client', client_secret: str = 'secret',
+                 token_lifetime: int = 3600, expire_every: int = 0):
+        """
+        Instantiates a mock ingestion server.
+
+        :param host: Interface to bind to, defaults to '127.0.0.1'
+        :type host: str, optional
+        :param port: Port to bind to, defaults to an available port
+        :type port: int, optional
+        :param refresh_route: Route for renewing access and refresh tokens, defaults to
+            '/auth/token'
+        :type refresh_route: str, optional
+        :param event_route: Route for ingesting cached logs, defaults to '/api/usage-event'
+        :type event_route: str, optional
+        :param client_id: Accepted client ID, defaults to 'client'
+        :type client_id: str, optional
+        :param client_secret: Accepted client secret, defaults to 'secret'
+        :type client_secret: str, optional
+        :param token_lifetime: Seconds until an access token expires, defaults to 3600
+        :type token_lifetime: int, optional
+        :param expire_every: Reject the access token of every nth upload as expired to
+            exercise the `TokenExpiredError` path, defaults to never
+        :type expire_every: int, optional
+        """
+        self.refresh_route = refresh_route
+        self.event_route = event_route
+        self.client_id = client_id
+        self.client_secret = client_secret
+        self.token_lifetime = token_lifetime
+        self.expire_every = expire_every
+        self.refresh_token = str(uuid.uuid4())
+        self.access_tokens = {}
+        self.install_id = str(uuid.uuid4())
+        self.renewing = False
+        self.stats = dict(refreshes=0, attempts=0, uploads=0, expired=0, events_received=0,
+                          bytes_received=0)
+        self._lock = threading.Lock()
+        self._server = http.server.ThreadingHTTPServer((host, port), _handler(self))
+        self._thread = None
+
+    @property
+    def url(self):
+        """
+        Base URL of the running server, use as `UsageAgent`'s `host`.
+        """
+        host, port = self._server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def start(self):
+        """
+        Start serving requests in a background thread.
+        """
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """
+        Stop serving requests.
+        """
+        self._server.shutdown()
+        self._server.server_close()
+        self._thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.stop()
+
+    def issue_token(self):
+        """
+        Issue a new access and refresh token pair.
+
+        :return: OAuth2 token response body
+        :rtype: dict
+        """
+        with self._lock:
+            access_token = str(uuid.uuid4())
+            self.refresh_token = str(uuid.uuid4())
+            self.access_tokens = {access_token: time.time() + self.token_lifetime}
+            self.stats['refreshes'] += 1
+            return dict(access_token=access_token, expires_in=self.token_lifetime,
+                        refresh_token=self.refresh_token, scope='usage', token_type='Bearer')
+
+
+def _handler(server):
+    class Handler(http.server.BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def reply(self, code, body):
+            data = json.dumps(body).encode('utf-8')
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_POST(self):
+            data = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            authorization = self.headers.get('Authorization', '')
+            if self.path == server.refresh_route:
+                form = urllib.parse.parse_qs(data.decode('utf-8'))
+                expected = base64.b64encode(
+                    f'{server.client_id}:{server.client_secret}'.encode('utf-8')).decode()
+                if (authorization != f'Basic {expected}' or
+                        form.get('grant_type') != ['refresh_token'] or
+                        form.get('refresh_token') != [server.refresh_token]):
+                    self.reply(401, dict(error_msg='Authorization Failed',
+                                         error_desc='Invalid client or refresh token.'))
+                else:
+                    self.reply(200, server.issue_token())
+            elif self.path == server.event_route:
+                access_token = authorization[len('Bearer '):]
+                with server._lock:
+                    server.stats['attempts'] += 1
+                    # the token presented for every nth upload is expired once, uploads
+                    # retried with its renewed replacement succeed
+                    expired = (server.access_tokens.get(access_token, 0) < time.time() or
+                               (server.expire_every and not server.renewing and
+                                (server.stats['uploads'] + 1) % server.expire_every == 0))
+                    server.renewing = bool(expired)
+                    if expired:
+                        server.stats['expired'] += 1
+                        server.access_tokens.pop(access_token, None)
+                    else:
+                        body = json.loads(data.decode('utf-8'))
+                        server.stats['uploads'] += 1
+                        server.stats['events_received'] += len(body['rows'])
+                        server.stats['bytes_received'] += len(data)
+                if expired:
+                    self.reply(401, dict(error_msg='Authorization Failed',
+                                         error_desc='TokenExpiredError: access token '
+                                                    'expired.'))
+                else:
+                    self.reply(200, dict(installId=body['installId']))
+            else:
+                self.reply(404, dict(error_msg='Not Found', error_desc=self.path))
+
+    return Handler
@@ -15,18 +15,34 @@ import uuid
 import sys
 import platform
 import subprocess
-import pkg_resources
+import importlib.metadata
+import concurrent.futures
 import contextlib
 import socket
 import urllib.parse
 import time
+import typing
+import itertools
 # logging
 import sqlite3
 # sending
 import urllib
 import urllib.error
+import urllib.request
 import base64
+# instrumentation
+import atexit
+import weakref
 from . import DISABLE_USAGE_TRACKING_PACKAGES
+from . import metrics
+from . import config
+
+PROBE_CACHE_MAX_AGE = 24 * 60 * 60
+SEGMENT_INTERVAL = 60
+CLAIM_TIMEOUT = 60 * 60
+METRICS_FLUSH_INTERVAL = 60
+# agents are referenced weakly so they can be garbage collected
+_agents = weakref.WeakSet()
 
 
 class UsageAgent:
@@ -37,7 +53,9 @@ class UsageAgent:
     def __init__(self, *, author: str, data_directory: str, package_name: str,
                  host: str = None, install_route: str = None, event_route: str = None,
                  refresh_route: str = None, response_timeout: int = 60,
-                 upload_frequency: str = '24h'):
+                 upload_frequency: str = '24h', multi_writer: bool = False,
+                 max_rows: int = None, max_bytes: int = None, max_age: str = None,
+                 prometheus: bool = None, segment_interval: float = None):
         """
         Instantiates a package usage data tracking agent. If prior configuration exists, loads
         from file.
@@ -62,6 +80,25 @@ class UsageAgent:
         :type response_timeout: str, optional
         :param upload_frequency: Usage data upload interval for daemon, defaults to '24h'
         :type upload_frequency: str, optional
+        :param multi_writer: Log to per-process, append-only segment files that the daemon
+            merges instead of writing to the cache directly. Avoids lock contention when many
+            processes log concurrently, defaults to False
+        :type multi_writer: bool, optional
+        :param max_rows: Maximum number of cached events, oldest are evicted first, defaults
+            to the saved value or else unbounded
+        :type max_rows: int, optional
+        :param max_bytes: Maximum size of the cache in bytes, oldest events are evicted first,
+            defaults to the saved value or else unbounded
+        :type max_bytes: int, optional
+        :param max_age: Maximum age of cached events e.g. 30d|12h, defaults to the saved
+            value or else unbounded
+        :type max_age: str, optional
+        :param prometheus: Write agent metrics as a Prometheus text file next to the cache,
+            defaults to the saved value or else False
+        :type prometheus: bool, optional
+        :param segment_interval: Seconds between multi-writer segment rotations, defaults to
+            `SEGMENT_INTERVAL`
+        :type segment_interval: float, optional
         """
         # verify `otumat` utility in PATH
         if package_name not in DISABLE_USAGE_TRACKING_PACKAGES:
@@ -77,24 +114,62 @@ class UsageAgent:
                                 "this-directory-to-path-or") from None
 
         self.home_path = pathlib.Path(appdirs.user_data_dir(data_directory, author), 'usage')
+        self.multi_writer = multi_writer
+        self.segment_interval = (SEGMENT_INTERVAL if segment_interval is None
+                                 else segment_interval)
+        self._segment = None
+        self._segment_key = None
+        self.metrics = metrics.Metrics()
+        self._metrics_flushed_at = time.monotonic()
+        # shared, cached view of the configuration which is kept current across processes
+        self.config_store = config.get_store(pathlib.Path(self.home_path, 'config.json'))
+        self.config_store.subscribe(self._on_config_change)
         try:
             # loading existing config
-            self.config = json.loads(pathlib.Path(self.home_path, 'config.json').read_text())
+            self.config = dict(self.config_store.load())
+            # retention and metrics settings specified by the package take precedence,
+            # agents built without them (e.g. the upload daemon) keep the saved values
+            updates = {k: v for k, v in dict(max_rows=max_rows, max_bytes=max_bytes,
+                                             max_age=max_age, prometheus=prometheus).items()
+                       if v is not None and self.config.get(k) != v}
+            if updates:
+                self.config.update(updates)
+                self.save_config()
         except FileNotFoundError:
             # initializing a new consent flow
             self.config = dict(author=author, data_directory=data_directory,
                                package_name=package_name, host=host,
                                install_route=install_route, event_route=event_route,
                                refresh_route=refresh_route, response_timeout=response_timeout,
-                               upload_frequency=upload_frequency)
+                               upload_frequency=upload_frequency, max_rows=max_rows,
+                               max_bytes=max_bytes, max_age=max_age,
+                               prometheus=bool(prometheus))
             self.install()
+        _agents.add(self)
 
     def save_config(self):
         """
         Save usage agent's configuration to disk.
         """
-        with open(pathlib.Path(self.home_path, 'config.json'), 'w') as f:
-            json.dump(self.config, f, indent=4, sort_keys=True)
+        self.config_store.save(self.config)
+
+    def _load_config(self):
+        """
+        Pick up configuration changes made elsewhere e.g. opt-outs and token refreshes. Costs
+        a single `stat` unless the configuration file changed.
+
+        :return: Current configuration
+        :rtype: dict
+        """
+        try:
+            self.config_store.load()
+        except FileNotFoundError:
+            # uninstalled by another process
+            self.config = dict(self.config, collect=False)
+        return self.config
+
+    def _on_config_change(self, config: dict):
+        self.config = dict(config)
 
     def uninstall(self):
         """
@@ -208,46 +283,20 @@ class UsageAgent:
             mac_address = ':'.join(re.findall('..', f'{uuid.getnode():012x}'))
             platform_name = 'Python'
             platform_version = '.'.join([str(v) for v in sys.version_info[:-2]])
-            try:
-                pkg_manager_version = subprocess.Popen(['conda', '--version'],
-                                                       stdout=subprocess.PIPE,
-                                                       stderr=subprocess.PIPE
-                                                       ).communicate()[0].decode(
-                                                        'utf-8').split()[1]
-                pkg_manager = 'conda'
-                _, package_version, package_build, pkg_manager_channel = subprocess.Popen(
-                    ['conda', 'list', self.config['package_name']], stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE).communicate()[0].decode('utf-8').split(
-                        '\n')[3].split()
-            except FileNotFoundError:
-                try:
-                    pkg_manager_version = subprocess.Popen(['pip', '--version'],
-                                                           stdout=subprocess.PIPE,
-                                                           stderr=subprocess.PIPE
-                                                           ).communicate()[0].decode(
-                                                            'utf-8').split()[1]
-                except FileNotFoundError:
-                    pkg_manager_version = subprocess.Popen(['pip3', '--version'],
-                                                           stdout=subprocess.PIPE,
-                                                           stderr=subprocess.PIPE
-                                                           ).communicate()[0].decode(
-                                                            'utf-8').split()[1]
-                pkg_manager = 'pip'
-                package_version = pkg_resources.get_distribution(
-                    self.config['package_name']).version
-            # determine net IP
-            with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
-                s.connect(("8.8.8.8", 80))
-                local_ip = s.getsockname()[0]
+            # probe package manager, network and location concurrently (cached per host)
+            probe = _probe_environment(package_name=self.config['package_name'])
+            pkg_manager = probe['pkg_manager']
+            pkg_manager_version = probe['pkg_manager_version']
+            package_version = probe['package_version']
+            local_ip = probe['local_ip']
+            location = probe['location']
+            timezone = ', '.join(list(time.tzname) + ([probe['timezone']]
+                                                      if probe['timezone'] else []))
             # determine available port
             with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_STREAM)) as s:
                 s.bind(('', 0))
                 s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
                 unused_port = s.getsockname()[1]
-            # determine location and timezone
-            geo_data = json.load(urllib.request.urlopen('http://ipinfo.io/json'))
-            location = ', '.join((geo_data['city'], geo_data['region'], geo_data['country']))
-            timezone = ', '.join(list(time.tzname) + [geo_data['timezone']])
             # build url
             initiated_timestamp = round(datetime.datetime.utcnow().timestamp())
             query_params = dict(operatingSystem=sys.platform, macAddress=mac_address,
@@ -261,7 +310,8 @@ class UsageAgent:
                                 redirect=f'http://{local_ip}:{unused_port}/install-completed',
                                 cancel=f'http://{local_ip}:{unused_port}/install-cancelled')
             link = f"""{self.config['host']}{self.config['install_route']}?{
-                urllib.parse.urlencode(query_params)}"""
+                urllib.parse.urlencode({k: v for k, v in query_params.items()
+                                        if v is not None})}"""
             # attempt to launch browser or provide instructions
             browser_available = True
             try:
@@ -303,15 +353,7 @@ class UsageAgent:
                                    package_version=package_version, location=location,
                                    timezone=timezone, timestamp=initiated_timestamp)
                 # instantiating local cache
-                with contextlib.closing(sqlite3.connect(
-                        str(pathlib.Path(self.home_path, 'main.db')))) as conn:
-                    with conn:
-                        conn.execute("""
-                        CREATE TABLE IF NOT EXISTS event(
-                            event_date datetime(3),
-                            event_type varchar(100)
-                        )
-                        """)
+                self.create_cache()
                 # preparing command for usage data upload daemon
                 cmd = ' '.join(['otumat', 'upload',
                                 '-a', self.config['author'],
@@ -333,6 +375,59 @@ class UsageAgent:
                     os.system(f'{cmd} &>/dev/null &')
         self.save_config()
 
+    def flush_metrics(self):
+        """
+        Persist the agent's in-memory metrics and update the Prometheus text file if enabled.
+        """
+        self._metrics_flushed_at = time.monotonic()
+        if self.config.get('collect') and self.home_path.is_dir():
+            db_path = str(pathlib.Path(self.home_path, 'main.db'))
+            try:
+                self.metrics.flush(db_path=db_path)
+                if self.config.get('prometheus'):
+                    metrics.write_prometheus(metrics=metrics.load(db_path=db_path),
+                                             path=pathlib.Path(self.home_path, 'metrics.prom'))
+            except (sqlite3.Error, OSError):
+                # metrics are best-effort and must never break the host package
+                pass
+
+    def _maybe_flush_metrics(self):
+        # long-running hosts publish metrics periodically rather than only at exit
+        if time.monotonic() - self._metrics_flushed_at > METRICS_FLUSH_INTERVAL:
+            self.flush_metrics()
+
+    def show_metrics(self):
+        """
+        Shows the usage agent's accumulated metrics.
+
+        :return: Metric kind and value by metric name
+        :rtype: dict
+        """
+        if self.config['collect']:
+            self.flush_metrics()
+            return metrics.load(db_path=str(pathlib.Path(self.home_path, 'main.db')))
+
+    def create_cache(self):
+        """
+        Create the local cache which buffers logged events.
+        """
+        with contextlib.closing(sqlite3.connect(
+                str(pathlib.Path(self.home_path, 'main.db')))) as conn:
+            # allow freed pages to be reclaimed incrementally after eviction
+            conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+            with conn:
+                conn.execute("""
+                CREATE TABLE IF NOT EXISTS event(
+                    event_date datetime(3),
+                    event_type varchar(100),
+                    attributes text
+                )
+                """)
+                # caches created before attributes were supported
+                if 'attributes' not in [r[1] for r in
+                                        conn.execute('PRAGMA table_info(event)')]:
+                    conn.execute('ALTER TABLE event ADD COLUMN attributes text')
+
     def show_logs(self):
         """
         Shows current usage tracking logs in cache.
@@ -346,61 +441,275 @@ class UsageAgent:
                 with conn:
                     return [r for r in conn.execute('SELECT * FROM event')]
 
-    def log(self, *, event_type: str):
+    def log(self, *, event_type: str, attributes: dict = None):
         """
         Logs new events into the cache to be picked up by daemon.
+
+        :param event_type: Type of event
+        :type event_type: str
+        :param attributes: Small JSON-serializable payload describing the event
+        :type attributes: dict, optional
         """
-        if self.config['collect']:
+        if self._load_config()['collect']:
+            start = time.perf_counter()
+            row = (datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f'), event_type,
+                   _encode_attributes(attributes))
+            if self.multi_writer:
+                self._log_segment(rows=[row])
+            else:
+                self._insert(rows=[row])
+            self.metrics.increment('events_logged_total')
+            self.metrics.observe('log_seconds', time.perf_counter() - start)
+            self._maybe_flush_metrics()
+
+    def log_many(self, events: typing.Iterable[tuple] = None, *,
+                 timestamps: typing.Iterable = None, event_types: typing.Iterable[str] = None,
+                 attributes: typing.Iterable[dict] = None):
+        """
+        Logs a batch of events into the cache in a single transaction. Events may be provided
+        row-wise as `(timestamp, event_type[, attributes])` tuples or column-wise as equal
+        length `timestamps`, `event_types`, and optionally `attributes`. A timestamp may be a
+        `datetime` (naive values are assumed UTC), POSIX seconds, an ISO 8601 string e.g.
+        '2022-01-01 00:00:00.000000', or None for the current time.
+
+        :param events: Rows of events
+        :type events: iterable, optional if columns are provided
+        :param timestamps: Column of event timestamps
+        :type timestamps: iterable, optional
+        :param event_types: Column of event types
+        :type event_types: iterable, optional
+        :param attributes: Column of small JSON-serializable payloads
+        :type attributes: iterable, optional
+        :return: Number of events logged
+        :rtype: int
+        """
+        if not self._load_config()['collect']:
+            return 0
+        start = time.perf_counter()
+        if events is None:
+            events = zip(timestamps, event_types,
+                         itertools.repeat(None) if attributes is None else attributes)
+        now = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+        rows = ((_format_event_date(timestamp=e[0], default=now), e[1],
+                 _encode_attributes(e[2]) if len(e) > 2 else None) for e in events)
+        if self.multi_writer:
+            rows = list(rows)
+            self._log_segment(rows=rows)
+            count = len(rows)
+        else:
+            count = self._insert(rows=rows)
+        self.metrics.increment('events_logged_total', count)
+        self.metrics.observe('log_many_seconds', time.perf_counter() - start)
+        self._maybe_flush_metrics()
+        return count
+
+    def _insert(self, *, rows: typing.Iterable[tuple]):
+        """
+        Inserts `(event_date, event_type, attributes)` rows into the cache in a single
+        transaction, upgrading caches created before attributes were supported.
+
+        :return: Number of rows inserted
+        :rtype: int
+        """
+        try:
             with contextlib.closing(sqlite3.connect(
                     str(pathlib.Path(self.home_path, 'main.db')))) as conn:
                 with conn:
-                    conn.execute('INSERT INTO event VALUES (?, ?)',
-                                 (datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f'),
-                                  event_type))
+                    conn.executemany('INSERT INTO event (event_date, event_type, attributes) '
+                                     'VALUES (?, ?, ?)', rows)
+                return conn.total_changes
+        except sqlite3.OperationalError as e:
+            # statement is rejected before any rows are consumed so it is safe to retry
+            if 'attributes' not in str(e):
+                raise
+            self.create_cache()
+            return self._insert(rows=rows)
+
+    def _log_segment(self, *, rows: list):
+        """
+        Appends events to this process' current segment file. Segments are rotated every
+        `segment_interval` seconds and are only ever written by a single process.
+        """
+        segment_key = (os.getpid(), int(time.time() // self.segment_interval))
+        if self._segment_key != segment_key:
+            if self._segment is not None and self._segment_key[0] == segment_key[0]:
+                self._segment.close()
+            segment_path = pathlib.Path(self.home_path, 'segments')
+            os.makedirs(segment_path, exist_ok=True)
+            self._segment = open(pathlib.Path(
+                segment_path, f'{segment_key[1]}-{segment_key[0]}.jsonl'), 'a')
+            self._segment_key = segment_key
+        self._segment.write(''.join(f'{json.dumps(row)}\n' for row in rows))
+        self._segment.flush()
+
+    def merge_segments(self):
+        """
+        Merges sealed segment files from multi-writer processes into the cache. A segment is
+        sealed once its rotation interval has fully elapsed so no process still writes to it.
+        Segments are merged one at a time, oldest first.
+        """
+        segment_path = pathlib.Path(self.home_path, 'segments')
+        sealed_bucket = int(time.time() // self.segment_interval) - 1
+        paths = [p for p in segment_path.glob('*.jsonl')
+                 if int(p.stem.split('-')[0]) < sealed_bucket]
+        # claims abandoned by a daemon that crashed mid-merge
+        for path in segment_path.glob('*.merging'):
+            try:
+                if time.time() - path.stat().st_mtime > CLAIM_TIMEOUT:
+                    paths.append(path)
+            except FileNotFoundError:
+                pass
+        for path in sorted(paths, key=lambda p: p.name):
+            segment = segment_path / f"{path.name.split('.')[0]}.jsonl"
+            # claim atomically so concurrent daemons never merge the same segment
+            claimed_path = segment.with_name(f'{segment.name}.{os.getpid()}.merging')
+            try:
+                os.replace(path, claimed_path)
+                # mark the claim's age so it is only recovered once abandoned
+                os.utime(claimed_path)
+                lines = claimed_path.read_text().splitlines()
+            except FileNotFoundError:
+                # claimed by another daemon
+                continue
+            rows = []
+            for line in lines:
+                try:
+                    row = tuple(json.loads(line))
+                    # segments written before attributes were supported
+                    rows.append(row + (None,) * (3 - len(row)))
+                except json.JSONDecodeError:
+                    # partial line from a writer that was interrupted
+                    pass
+            try:
+                self._insert(rows=rows)
+            except BaseException:
+                # release the claim so a later cycle merges the segment, e.g. once the cache
+                # is no longer locked
+                os.replace(claimed_path, segment)
+                raise
+            claimed_path.unlink(missing_ok=True)
+            self.metrics.increment('segments_merged_total')
+            self.metrics.increment('events_merged_total', len(rows))
+
+    def enforce_retention(self):
+        """
+        Evicts oldest cached events that exceed the configured maximum age, row count, or
+        size, then reclaims freed space.
+        """
+        if not any(self.config.get(k) for k in ('max_rows', 'max_bytes', 'max_age')):
+            return
+        with contextlib.closing(sqlite3.connect(
+                str(pathlib.Path(self.home_path, 'main.db')), isolation_level=None)) as conn:
+            evicted = 0
+            if self.config.get('max_age'):
+                cutoff = datetime.datetime.utcnow() - datetime.timedelta(
+                    seconds=_parse_period(frequency=self.config['max_age']))
+                evicted += conn.execute('DELETE FROM event WHERE event_date < ?',
+                                        (cutoff.strftime('%Y-%m-%d %H:%M:%S.%f'),)
+                                        ).rowcount
+            count = conn.execute('SELECT count(*) FROM event').fetchone()[0]
+            excess = 0
+            if self.config.get('max_rows') and count > self.config['max_rows']:
+                excess = count - self.config['max_rows']
+            if self.config.get('max_bytes') and count:
+                page_size, page_count, freelist_count = [
+                    conn.execute(f'PRAGMA {p}').fetchone()[0]
+                    for p in ('page_size', 'page_count', 'freelist_count')]
+                used_bytes = page_size * (page_count - freelist_count)
+                if used_bytes > self.config['max_bytes']:
+                    # estimate rows to evict from the average row footprint
+                    excess = max(excess, -(-(used_bytes - self.config['max_bytes']) * count //
+                                           used_bytes))
+            if excess:
+                # backdated events may be inserted late so evict by event date
+                evicted += conn.execute(
+                    'DELETE FROM event WHERE rowid IN '
+                    '(SELECT rowid FROM event ORDER BY event_date, rowid LIMIT ?)',
+                    (excess,)).rowcount
+            if evicted:
+                self.metrics.increment('events_evicted_total', evicted)
+                if conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2:
+                    # runs to completion, stepping via `execute` frees only a single page
+                    conn.executescript('PRAGMA incremental_vacuum;')
+                else:
+                    # caches created before incremental vacuum require a one-time rebuild
+                    conn.execute('PRAGMA auto_vacuum = INCREMENTAL')
+                    conn.execute('VACUUM')
 
     def send(self):
         """
         Unloads cached logs and uploads data to usage data tracking remote host.
         """
-        if self.config['collect']:
-            with contextlib.closing(sqlite3.connect(
-                    str(pathlib.Path(self.home_path, 'main.db')))) as conn:
-                with conn:
-                    # always ensure refresh token is current
-                    self.refresh_token()
-                    # fetch cached data
-                    current_time = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
-                    rows = [r for r in conn.execute('SELECT * FROM event WHERE event_date < ?',
-                                                    (current_time,))]
-                    if len(rows) == 0:
-                        print('Nothing to send for this cycle.')
-                    else:
-                        # logs detected, build request to insert logs
-                        body = dict(installId=self.config['install_id'],
-                                    headers=['install_id', 'event_date', 'event_type'],
-                                    rows=rows)
-                        req = urllib.request.Request(
-                            f"{self.config['host']}{self.config['event_route']}",
-                            headers={'Content-Type': 'application/json',
-                                     'Authorization': f"Bearer {self.config['access_token']}"},
-                            data=json.dumps(body).encode('utf-8'))
-                        try:
-                            urllib.request.urlopen(req)
-                        except urllib.error.HTTPError as e:
-                            error_body = json.loads(e.read().decode())
-                            if (e.code == 401 and isinstance(error_body, dict) and
-                                    error_body['error_msg'] == 'Authorization Failed' and
-                                    'TokenExpiredError' in error_body['error_desc']):
-                                # access token expired, try again with a new refresh token
-                                self.send()
-                            else:
-                                raise Exception('Unexpected server response...')
-                        except urllib.error.URLError:
-                            raise Exception('Connection refused when sending usage logs.')
+        if self._load_config()['collect']:
+            # collect events logged by multi-writer processes
+            self.merge_segments()
+            # ensure cache is up to date and bounded, e.g. if uploads have been failing
+            self.create_cache()
+            self.enforce_retention()
+            start = time.perf_counter()
+            self.metrics.increment('sends_total')
+            self._upload()
+            self.metrics.observe('send_seconds', time.perf_counter() - start)
+
+    def _upload(self):
+        """
+        Uploads cached logs, retrying with a renewed access token if it expired.
+        """
+        with contextlib.closing(sqlite3.connect(
+                str(pathlib.Path(self.home_path, 'main.db')))) as conn:
+            with conn:
+                # always ensure refresh token is current
+                self.refresh_token()
+                if not self.config['collect']:
+                    # opted out while the token was being renewed
+                    return
+                # fetch cached data
+                current_time = datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+                rows = [r for r in conn.execute(
+                    'SELECT event_date, event_type, attributes FROM event '
+                    'WHERE event_date < ?', (current_time,))]
+                headers = ['install_id', 'event_date', 'event_type', 'attributes']
+                if not any(r[2] is not None for r in rows):
+                    # only include attributes when used to keep uploads compact
+                    headers = headers[:-1]
+                    rows = [r[:2] for r in rows]
+                self.metrics.gauge('queue_depth', len(rows))
+                if len(rows) == 0:
+                    print('Nothing to send for this cycle.')
+                else:
+                    # logs detected, build request to insert logs
+                    body = dict(installId=self.config['install_id'],
+                                headers=headers, rows=rows)
+                    req = urllib.request.Request(
+                        f"{self.config['host']}{self.config['event_route']}",
+                        headers={'Content-Type': 'application/json',
+                                 'Authorization': f"Bearer {self.config['access_token']}"},
+                        data=json.dumps(body).encode('utf-8'))
+                    try:
+                        urllib.request.urlopen(req)
+                    except urllib.error.HTTPError as e:
+                        error_body = json.loads(e.read().decode())
+                        if (e.code == 401 and isinstance(error_body, dict) and
+                                error_body['error_msg'] == 'Authorization Failed' and
+                                'TokenExpiredError' in error_body['error_desc']):
+                            # access token expired, try again with a new refresh token
+                            self.metrics.increment('send_retries_total')
+                            self._upload()
                         else:
-                            # insert successful, removing associated cached logs
-                            conn.execute('DELETE FROM event WHERE event_date < ?',
-                                         (current_time,))
+                            self.metrics.increment('send_errors_total')
+                            raise Exception('Unexpected server response...')
+                    except urllib.error.URLError:
+                        self.metrics.increment('send_errors_total')
+                        raise Exception('Connection refused when sending usage logs.')
+                    else:
+                        # insert successful, removing associated cached logs
+                        conn.execute('DELETE FROM event WHERE event_date < ?',
+                                     (current_time,))
+                        self.metrics.increment('events_sent_total', len(rows))
+                        self.metrics.increment('bytes_sent_total', len(req.data))
+                        self.metrics.observe('upload_batch_rows', len(rows))
+                        self.metrics.gauge('last_send_timestamp',
+                                           datetime.datetime.utcnow().timestamp())
 
     def refresh_token(self):
         """
@@ -417,24 +726,34 @@ class UsageAgent:
                 data=urllib.parse.urlencode(
                     dict(grant_type='refresh_token',
                          refresh_token=self.config['refresh_token'])).encode('utf-8'))
+            self.metrics.increment('token_refreshes_total')
             try:
                 response = urllib.request.urlopen(req)
             except urllib.error.HTTPError:
+                self.metrics.increment('token_refresh_errors_total')
                 # access denied b/c refresh token has now expired
                 print('Usage upload connection has gone stale, requesting user to renew '
                       'token manually...')
                 self.install()
             except urllib.error.URLError:
+                self.metrics.increment('token_refresh_errors_total')
                 raise Exception('Connection refused when requesting a new token.')
             else:
                 # token returned successfully, update configuration
                 body = json.load(response)
-                self.config['access_token'] = body['access_token']
-                self.config['expires_at'] = (datetime.datetime.utcnow().timestamp() +
-                                             int(body['expires_in']))
-                self.config['refresh_token'] = body['refresh_token']
-                self.config['scope'] = body['scope']
-                self.save_config()
+                try:
+                    # only apply the tokens so changes saved meanwhile e.g. opt-outs are kept
+                    self.config = dict(self.config_store.load(),
+                                       access_token=body['access_token'],
+                                       expires_at=(datetime.datetime.utcnow().timestamp() +
+                                                   int(body['expires_in'])),
+                                       refresh_token=body['refresh_token'],
+                                       scope=body['scope'])
+                except FileNotFoundError:
+                    # uninstalled by another process
+                    self.config = dict(self.config, collect=False)
+                else:
+                    self.save_config()
 
     def recurring_send(self, *, start: datetime.datetime, frequency: str = '24h'):
         """
@@ -446,26 +765,186 @@ class UsageAgent:
         :type frequency: str, optional
         """
         # determine period in seconds
-        period, unit = [int(e) if e.isdigit() else e
-                        for e in re.findall(r'([0-9]+)([a-z]+)', frequency)[0]]
-        if unit == 's':
-            pass
-        elif unit == 'm':
-            period *= 60
-        elif unit == 'h':
-            period *= 60 * 60
-        elif unit == 'd':
-            period *= 24 * 60 * 60
-        else:
-            raise Exception(f'Unexpected unit `{unit}` specified.')
+        period = _parse_period(frequency=frequency)
         # delay if start datetime has not happened yet
         if datetime.datetime.utcnow() < start:
             time.sleep([_[0].seconds + _[0].microseconds/1e6 - 1
                         for _ in zip([start - datetime.datetime.utcnow()])][0])
         # periodically unload cached usage data logs, checking config should user opt-out
-        while json.loads(pathlib.Path(self.home_path, 'config.json').read_text())['collect']:
+        while self.config_store.load()['collect']:
             time.sleep(period - datetime.datetime.utcnow().timestamp() % period)
-            self.send()
+            self.metrics.increment('upload_cycles_total')
+            try:
+                self.send()
+            except Exception as e:
+                # keep the schedule, and with it cache retention, going while offline
+                self.metrics.increment('upload_cycle_errors_total')
+                print(f'Usage upload failed, retrying next cycle: {e}')
+            finally:
+                self.flush_metrics()
+
+
+@atexit.register
+def _flush_agent_metrics():
+    for agent in list(_agents):
+        agent.flush_metrics()
+
+
+def _format_event_date(*, timestamp, default: str):
+    if timestamp is None:
+        return default
+    elif isinstance(timestamp, str):
+        # normalized since event dates are compared lexically, raises ValueError if invalid
+        timestamp = datetime.datetime.fromisoformat(timestamp)
+    elif isinstance(timestamp, (int, float)):
+        timestamp = datetime.datetime.fromtimestamp(timestamp, datetime.timezone.utc)
+    elif not isinstance(timestamp, datetime.datetime):
+        raise TypeError(f'Unexpected timestamp `{timestamp!r}` specified.')
+    if timestamp.tzinfo is not None:
+        timestamp = timestamp.astimezone(datetime.timezone.utc)
+    return timestamp.strftime('%Y-%m-%d %H:%M:%S.%f')
+
+
+def _encode_attributes(attributes):
+    # compact JSON, attributes are optional so absent payloads take no space
+    return None if attributes is None else json.dumps(attributes, separators=(',', ':'))
+
+
+def _parse_period(*, frequency: str):
+    """
+    Converts a period such as 30s|1m|15m|1h|12h|30d into seconds.
+
+    :param frequency: Period to convert
+    :type frequency: str
+    :return: Number of seconds in period
+    :rtype: int
+    """
+    period, unit = [int(e) if e.isdigit() else e
+                    for e in re.findall(r'([0-9]+)([a-z]+)', frequency)[0]]
+    if unit == 's':
+        pass
+    elif unit == 'm':
+        period *= 60
+    elif unit == 'h':
+        period *= 60 * 60
+    elif unit == 'd':
+        period *= 24 * 60 * 60
+    else:
+        raise Exception(f'Unexpected unit `{unit}` specified.')
+    return period
+
+
+def _probe_environment(*, package_name: str, timeout: int = 10):
+    """
+    Determines package manager, package version, network, and location details. Probes run
+    concurrently, bounded by a timeout, and slow results are cached in a host-level file
+    keyed by interpreter path and environment so other installs on the host can reuse them.
+
+    :param package_name: Installed package name
+    :type package_name: str
+    :param timeout: Timeout in seconds for the probes, defaults to 10
+    :type timeout: int, optional
+    :return: Environment details, any that could not be determined are None
+    :rtype: dict
+    """
+    cache_path = pathlib.Path(appdirs.user_cache_dir('otumat'), 'probe.json')
+    cache_key = '|'.join((sys.executable, sys.prefix, os.getenv('CONDA_PREFIX', '')))
+    try:
+        cache = json.loads(cache_path.read_text())
+    except (FileNotFoundError, json.JSONDecodeError):
+        cache = {}
+    cached = cache.get(cache_key)
+    if (cached is not None and
+            datetime.datetime.utcnow().timestamp() - cached['timestamp'] >
+            PROBE_CACHE_MAX_AGE):
+        cached = None
+    probes = dict(local_ip=_probe_local_ip)
+    if cached is None:
+        probes = dict(probes, conda_version=_probe_conda_version, geo_data=_probe_geo_data)
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=len(probes))
+    futures = {k: executor.submit(v, timeout=timeout) for k, v in probes.items()}
+    # socket timeouts do not cover e.g. DNS resolution so bound the probes as a whole
+    concurrent.futures.wait(futures.values(), timeout=timeout)
+    # never wait on probes that are still running
+    executor.shutdown(wait=False)
+    results = {}
+    failed = set()
+    for k, future in futures.items():
+        try:
+            results[k] = future.result(timeout=0)
+        except Exception:
+            # includes timeouts, e.g. a slow `conda` or a hung resolver
+            results[k] = None
+            failed.add(k)
+    if cached is None:
+        geo_data = results['geo_data'] or {}
+        if 'conda_version' in failed:
+            # unknown whether conda manages this environment
+            pkg_manager, pkg_manager_version = None, None
+        elif results['conda_version']:
+            pkg_manager, pkg_manager_version = 'conda', results['conda_version']
+        else:
+            try:
+                pkg_manager, pkg_manager_version = 'pip', importlib.metadata.version('pip')
+            except importlib.metadata.PackageNotFoundError:
+                pkg_manager, pkg_manager_version = 'pip', None
+        cached = dict(timestamp=datetime.datetime.utcnow().timestamp(),
+                      pkg_manager=pkg_manager, pkg_manager_version=pkg_manager_version,
+                      location=(', '.join((geo_data['city'], geo_data['region'],
+                                           geo_data['country']))
+                                if all(k in geo_data for k in ('city', 'region', 'country'))
+                                else None),
+                      timezone=geo_data.get('timezone'))
+        if not failed & {'conda_version', 'geo_data'}:
+            # only persist complete results so a failure or timeout is retried next time
+            try:
+                os.makedirs(cache_path.parent, exist_ok=True)
+                tmp_path = cache_path.with_name(f'{cache_path.name}.{os.getpid()}.tmp')
+                tmp_path.write_text(json.dumps(dict(cache, **{cache_key: cached}), indent=4,
+                                               sort_keys=True))
+                os.replace(tmp_path, cache_path)
+            except OSError:
+                pass
+    try:
+        package_version = importlib.metadata.version(package_name)
+    except importlib.metadata.PackageNotFoundError:
+        package_version = (_probe_conda_package_version(package_name=package_name,
+                                                        timeout=timeout)
+                           if cached['pkg_manager'] == 'conda' else None)
+    return dict({k: v for k, v in cached.items() if k != 'timestamp'},
+                package_version=package_version,
+                local_ip=results['local_ip'] or '127.0.0.1')
+
+
+def _probe_conda_version(*, timeout: int):
+    try:
+        return subprocess.run(['conda', '--version'], stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, timeout=timeout
+                              ).stdout.decode('utf-8').split()[1]
+    except FileNotFoundError:
+        return None
+
+
+def _probe_conda_package_version(*, package_name: str, timeout: int):
+    try:
+        return subprocess.run(['conda', 'list', package_name], stdout=subprocess.PIPE,
+                              stderr=subprocess.PIPE, timeout=timeout
+                              ).stdout.decode('utf-8').split('\n')[3].split()[1]
+    except (FileNotFoundError, subprocess.TimeoutExpired, IndexError):
+        return None
+
+
+def _probe_local_ip(*, timeout: int):
+    # determine net IP, no packets are sent for a UDP connect
+    with contextlib.closing(socket.socket(socket.AF_INET, socket.SOCK_DGRAM)) as s:
+        s.settimeout(timeout)
+        s.connect(("8.8.8.8", 80))
+        return s.getsockname()[0]
+
+
+def _probe_geo_data(*, timeout: int):
+    # determine location and timezone
+    return json.load(urllib.request.urlopen('http://ipinfo.io/json', timeout=timeout))
 
 
 def _delayed_request(*, url: str, delay: str = 0):
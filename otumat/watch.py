@@ -1,19 +1,29 @@
 import subprocess
+import pathlib
+import json
+import os
 from datetime import datetime
+from . import hash_file
 from watchdog.observers.polling import PollingObserver
-from watchdog.events import FileSystemEventHandler
+from watchdog.events import PatternMatchingEventHandler
+from watchdog.utils.patterns import match_any_paths
 
 
 class OnMyWatch:
-    def __init__(self, watch_file, watch_interval, watch_script, watch_args):
+    def __init__(self, watches, watch_interval):
         self.observer = PollingObserver(timeout=watch_interval)
-        self.watch_directory = watch_file
-        self.watch_script = watch_script
-        self.watch_args = watch_args
+        self.watches = watches
 
     def run(self):
-        event_handler = Handler(self.watch_directory, self.watch_script, self.watch_args)
-        self.observer.schedule(event_handler, self.watch_directory, recursive=True)
+        # a single observer serves every watch, each with its own filtered handler shared by
+        # all of its paths so they see the same script state
+        for watch in self.watches:
+            event_handler = Handler(watch['paths'], watch['script'], watch['args'],
+                                    include=watch['include'], exclude=watch['exclude'],
+                                    digest=watch['digest'])
+            for path in watch['paths']:
+                self.observer.schedule(event_handler, path,
+                                       recursive=pathlib.Path(path).is_dir())
         self.observer.start()
         try:
             self.observer.join()
@@ -22,18 +32,58 @@ class OnMyWatch:
             print("\nObserver Stopped")
 
 
-class Handler(FileSystemEventHandler):
+class Handler(PatternMatchingEventHandler):
 
-    def __init__(self, watch_file, watch_script, watch_args):
+    def __init__(self, watch_file, watch_script, watch_args, include=None, exclude=None,
+                 digest=False, case_sensitive=False):
+        # patterns are matched by `dispatch` so unwanted events never reach `on_any_event`
+        super().__init__(patterns=include or None, ignore_patterns=exclude or None,
+                         ignore_directories=True, case_sensitive=case_sensitive)
         self.watch_file = watch_file
         self.watch_script = watch_script
         self.watch_args = watch_args
+        self.digests = {}
+        if digest:
+            # record initial digests so the first real change is the first run
+            for watch_path in [watch_file] if isinstance(watch_file, str) else watch_file:
+                for path in ([pathlib.Path(watch_path)] if os.path.isfile(watch_path)
+                             else pathlib.Path(watch_path).rglob('*')):
+                    if path.is_file() and self._matches(str(path)):
+                        self.changed(str(path))
+        else:
+            self.digests = None
+
+    def _matches(self, path):
+        # same filtering as `dispatch`
+        return match_any_paths([path], included_patterns=self.patterns,
+                               excluded_patterns=self.ignore_patterns,
+                               case_sensitive=self.case_sensitive)
+
+    def changed(self, path):
+        """
+        Determine if a file's content differs from the last seen digest.
+
+        :param path: Path to modified file
+        :type path: str
+        :return: True if content changed or digest checks are disabled
+        :rtype: bool
+        """
+        if self.digests is None:
+            return True
+        try:
+            digest = hash_file(filepath=path)
+        except (FileNotFoundError, IsADirectoryError, PermissionError):
+            return False
+        if self.digests.get(path) == digest:
+            return False
+        self.digests[path] = digest
+        return True
 
     def on_any_event(self, event):
         if event.is_directory:
             return None
 
-        elif event.event_type == 'modified':
+        elif event.event_type == 'modified' and self.changed(event.src_path):
             # Event is modified, you can process it now
             print(f'=== [{datetime.now().isoformat()}] \
                 OTUMAT WATCH: {event.src_path} modified ===')
@@ -43,8 +93,85 @@ class Handler(FileSystemEventHandler):
 
 
 class WatchAgent():
-    def __init__(self, watch_file, watch_interval, watch_script, watch_args):
-        self.watch = OnMyWatch(watch_file, watch_interval, watch_script, watch_args)
+    def __init__(self, watch_file=None, watch_interval=None, watch_script=None,
+                 watch_args=None, watch_include=None, watch_exclude=None, watch_spec=None,
+                 watch_digest=False):
+        """
+        Instantiates a file watching agent. Watches may be provided directly, through a spec
+        file, or both. All watches are served by a single observer.
+
+        :param watch_file: Path(s) to be watched
+        :type watch_file: str or list, optional if `watch_spec` provided
+        :param watch_interval: Interval between polls in seconds, defaults to the spec's
+            `interval` or else 5
+        :type watch_interval: int, optional
+        :param watch_script: Script to run on change for `watch_file`
+        :type watch_script: str, optional if `watch_spec` provided
+        :param watch_args: Arguments providing state between runs, defaults to no arguments
+        :type watch_args: list, optional
+        :param watch_include: Glob patterns of paths that trigger a run, defaults to all
+        :type watch_include: list, optional
+        :param watch_exclude: Glob patterns of paths that never trigger a run
+        :type watch_exclude: list, optional
+        :param watch_spec: Path to a JSON/YAML file mapping paths and globs to scripts
+        :type watch_spec: str, optional
+        :param watch_digest: Only run when file content changes (by SHA1 digest) for
+            `watch_file`, defaults to False
+        :type watch_digest: bool, optional
+        """
+        watches = []
+        if watch_file is not None:
+            watches.append(dict(paths=([watch_file] if isinstance(watch_file, str)
+                                       else list(watch_file)),
+                                script=watch_script, args=list(watch_args or []),
+                                include=list(watch_include or []),
+                                exclude=list(watch_exclude or []), digest=watch_digest))
+        if watch_spec is not None:
+            spec = load_spec(watch_spec)
+            if watch_interval is None:
+                watch_interval = spec.get('interval')
+            watches.extend(spec['watches'])
+        if not watches:
+            raise Exception('No watches specified.')
+        self.watch = OnMyWatch(watches, 5 if watch_interval is None else watch_interval)
 
     def run(self):
         self.watch.run()
+
+
+def load_spec(spec_path):
+    """
+    Loads a watch spec file. Expected structure (JSON or YAML):
+
+        {"interval": 5,
+         "watches": [{"path": "/data", "script": "./reload.sh", "args": [],
+                      "include": ["*.json"], "exclude": ["*.tmp"], "digest": true}]}
+
+    A watch's `path` may also be a list of paths which then share the script's state.
+
+    :param spec_path: Path to spec file
+    :type spec_path: str
+    :return: Spec with defaults applied to each watch
+    :rtype: dict
+    """
+    spec_path = pathlib.Path(spec_path)
+    if spec_path.suffix in ('.yaml', '.yml'):
+        try:
+            import yaml
+        except ImportError:
+            raise Exception('`pyyaml` is required to load YAML watch specs.') from None
+        spec = yaml.safe_load(spec_path.read_text())
+    else:
+        spec = json.loads(spec_path.read_text())
+    watches = []
+    for watch in spec.get('watches', []):
+        if 'path' not in watch or 'script' not in watch:
+            raise Exception(f'Watch `{watch}` must specify a `path` and `script`.')
+        watches.append(dict(paths=([watch['path']] if isinstance(watch['path'], str)
+                                   else list(watch['path'])),
+                            script=watch['script'],
+                            args=list(watch.get('args', [])),
+                            include=list(watch.get('include', [])),
+                            exclude=list(watch.get('exclude', [])),
+                            digest=bool(watch.get('digest', False))))
+    return dict(spec, watches=watches)
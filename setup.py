@@ -36,5 +36,6 @@ setuptools.setup(
         'console_scripts': [
             f'{package.__name__}={package.__name__}.command_line:{package.__name__}'],
     },
+    python_requires='>=3.8',
     install_requires=requirements,
 )
@@ -1,7 +1,444 @@
-from otumat.watch import WatchAgent
+import gc
+import os
+import json
+import weakref
+import time
+import threading
+import pathlib
+import datetime
+import sqlite3
+import pytest
+from otumat import hash_file, usage, metrics, config, command_line, benchmark
+from watchdog.events import FileModifiedEvent
+from otumat.watch import WatchAgent, Handler
+from otumat.mock import MockIngestServer
+
+
+def _usage_agent(home_path, multi_writer=False, **settings):
+    # bypass the installation flow
+    agent = usage.UsageAgent.__new__(usage.UsageAgent)
+    agent.home_path = home_path
+    agent.config = dict(collect=True, **settings)
+    agent.multi_writer = multi_writer
+    agent.segment_interval = usage.SEGMENT_INTERVAL
+    agent._segment = None
+    agent._segment_key = None
+    agent.metrics = metrics.Metrics()
+    agent._metrics_flushed_at = time.monotonic()
+    agent.config_store = config.ConfigStore(home_path / 'config.json')
+    agent.config_store.subscribe(agent._on_config_change)
+    home_path.mkdir(exist_ok=True)
+    agent.save_config()
+    return agent
 
 
 def test_watch_agent():
     test_watch_agent = WatchAgent('/test_general.py', 5, '../main/test.sh', [])
 
     assert isinstance(test_watch_agent, WatchAgent)
+
+
+def test_watch_agent_spec(tmp_path):
+    spec_path = tmp_path / 'spec.json'
+    spec_path.write_text(json.dumps(dict(interval=1, watches=[
+        dict(path=str(tmp_path), script='../main/test.sh', include=['*.json']),
+        dict(path='/test_general.py', script='../main/other.sh', args=['a'])])))
+    test_watch_agent = WatchAgent('/other.py', watch_script='../main/test.sh',
+                                  watch_spec=str(spec_path))
+
+    assert [w['paths'] for w in test_watch_agent.watch.watches] == [
+        ['/other.py'], [str(tmp_path)], ['/test_general.py']]
+    assert test_watch_agent.watch.watches[1]['exclude'] == []
+    assert test_watch_agent.watch.watches[2]['args'] == ['a']
+    assert test_watch_agent.watch.observer.timeout == 1
+    assert WatchAgent('/other.py', 3, '../main/test.sh', [],
+                      watch_spec=str(spec_path)).watch.observer.timeout == 3
+    # repeated paths share a single watch so script state is shared
+    assert [w['paths'] for w in WatchAgent(['/a.py', '/b.py'], 3, '../main/test.sh',
+                                           ['state']).watch.watches] == [['/a.py', '/b.py']]
+
+
+def test_watch_handler_filter():
+    handler = Handler('/data', '../main/test.sh', [], include=['*.json'],
+                      exclude=['*skip*'], case_sensitive=True)
+    handler.on_any_event = lambda event: triggered.append(event.src_path)
+    triggered = []
+    for src_path in ('/data/a.json', '/data/b.txt', '/data/skip.json', '/data/C.JSON'):
+        handler.dispatch(FileModifiedEvent(src_path))
+
+    assert triggered == ['/data/a.json']
+
+
+def test_watch_handler_digest(tmp_path):
+    watched = tmp_path / 'config.json'
+    watched.write_text('{}')
+    handler = Handler(str(tmp_path), '../main/test.sh', [], digest=True)
+
+    assert not handler.changed(str(watched))
+    watched.write_text('{}')
+    assert not handler.changed(str(watched))
+    watched.write_text('{"a": 1}')
+    assert handler.changed(str(watched))
+    assert handler.digests[str(watched)] == hash_file(filepath=str(watched))
+
+
+def test_probe_environment_cache(tmp_path, monkeypatch):
+    calls = []
+    monkeypatch.setattr(usage.appdirs, 'user_cache_dir', lambda *args: str(tmp_path))
+    monkeypatch.setattr(usage, '_probe_conda_version', lambda **kwargs: None)
+    monkeypatch.setattr(usage, '_probe_geo_data', lambda **kwargs: calls.append(1) or dict(
+        city='Houston', region='Texas', country='US', timezone='America/Chicago'))
+    first = usage._probe_environment(package_name='watchdog', timeout=1)
+    second = usage._probe_environment(package_name='watchdog', timeout=1)
+
+    assert first == second
+    assert calls == [1]
+    assert first['pkg_manager'] == 'pip'
+    assert first['location'] == 'Houston, Texas, US'
+    assert (tmp_path / 'probe.json').is_file()
+
+
+def test_usage_agent_multi_writer(tmp_path, monkeypatch):
+    agent = _usage_agent(tmp_path, multi_writer=True)
+    with sqlite3.connect(str(tmp_path / 'main.db')) as conn:
+        conn.execute('CREATE TABLE event(event_date datetime(3), event_type varchar(100))')
+    agent.log(event_type='import')
+    agent.log(event_type='fetch')
+    agent.merge_segments()
+
+    assert agent.show_logs() == []
+    agent.segment_interval = 1e-3
+    agent.merge_segments()
+
+    assert [r[1] for r in agent.show_logs()] == ['import', 'fetch']
+    assert list((tmp_path / 'segments').iterdir()) == []
+
+    # a concurrent daemon claims the segment between listing and claiming
+    agent.log(event_type='insert')
+    segment = next((tmp_path / 'segments').iterdir())
+    glob = pathlib.Path.glob
+    monkeypatch.setattr(pathlib.Path, 'glob', lambda self, pattern: [
+        p for p in glob(self, pattern)] + [segment])
+    time.sleep(0.01)
+    agent.merge_segments()
+
+    assert [r[1] for r in agent.show_logs()] == ['import', 'fetch', 'insert']
+
+
+def test_usage_agent_merge_failure(tmp_path):
+    agent = _usage_agent(tmp_path, multi_writer=True)
+    agent.create_cache()
+    agent.segment_interval = 1e-3
+    agent.log(event_type='import')
+    time.sleep(0.01)
+    insert = agent._insert
+
+    def locked(**kwargs):
+        raise sqlite3.OperationalError('database is locked')
+
+    # a failed insert releases the claim so the next cycle merges the segment
+    agent._insert = locked
+    with pytest.raises(sqlite3.OperationalError):
+        agent.merge_segments()
+    assert [p.suffix for p in (tmp_path / 'segments').iterdir()] == ['.jsonl']
+    agent._insert = insert
+    agent.merge_segments()
+
+    assert [r[1] for r in agent.show_logs()] == ['import']
+    # claims abandoned by a crashed daemon are recovered once stale
+    agent.log(event_type='fetch')
+    time.sleep(0.01)
+    segment = next((tmp_path / 'segments').iterdir())
+    claimed = segment.with_name(f'{segment.name}.1.merging')
+    segment.rename(claimed)
+    agent.merge_segments()
+
+    assert claimed.exists()
+    os.utime(claimed, (0, 0))
+    agent.merge_segments()
+
+    assert [r[1] for r in agent.show_logs()] == ['import', 'fetch']
+    assert list((tmp_path / 'segments').iterdir()) == []
+
+
+def test_usage_agent_retention(tmp_path):
+    agent = _usage_agent(tmp_path, max_rows=3, max_age='1d')
+    with sqlite3.connect(str(tmp_path / 'main.db')) as conn:
+        conn.execute('CREATE TABLE event(event_date datetime(3), event_type varchar(100))')
+        conn.executemany('INSERT INTO event VALUES (?, ?)', [
+            ('2000-01-01 00:00:00.000000', 'stale')] + [
+            (datetime.datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f'), f'event{i}')
+            for i in range(5)])
+    agent.enforce_retention()
+
+    assert [r[1] for r in agent.show_logs()] == ['event2', 'event3', 'event4']
+    with sqlite3.connect(str(tmp_path / 'main.db')) as conn:
+        assert conn.execute('PRAGMA auto_vacuum').fetchone()[0] == 2
+
+    # freed pages are fully reclaimed once incremental vacuuming is enabled
+    agent.config = dict(agent.config, max_rows=10)
+    agent.log_many((None, 'bulk', dict(padding='x' * 100)) for _ in range(5000))
+    size = (tmp_path / 'main.db').stat().st_size
+    agent.enforce_retention()
+
+    assert len(agent.show_logs()) == 10
+    assert (tmp_path / 'main.db').stat().st_size < size / 10
+    with sqlite3.connect(str(tmp_path / 'main.db')) as conn:
+        assert conn.execute('PRAGMA freelist_count').fetchone()[0] == 0
+
+
+def test_usage_agent_retention_config(tmp_path, monkeypatch):
+    monkeypatch.setattr(usage, 'DISABLE_USAGE_TRACKING_PACKAGES', ['pkg'])
+    monkeypatch.setattr(usage.appdirs, 'user_data_dir', lambda *args: str(tmp_path))
+    (tmp_path / 'usage').mkdir()
+    (tmp_path / 'usage' / 'config.json').write_text(json.dumps(dict(
+        collect=False, package_name='pkg')))
+    # upload daemon built without retention policies saves none
+    usage.UsageAgent(author='a', data_directory='d', package_name='pkg')
+    saved = json.loads((tmp_path / 'usage' / 'config.json').read_text())
+    assert all(k not in saved for k in ('max_rows', 'max_bytes', 'max_age'))
+    # package policies take precedence and persist
+    usage.UsageAgent(author='a', data_directory='d', package_name='pkg', max_rows=10,
+                     max_age='30d')
+    usage.UsageAgent(author='a', data_directory='d', package_name='pkg', max_rows=20)
+    usage.UsageAgent(author='a', data_directory='d', package_name='pkg')
+    saved = json.loads((tmp_path / 'usage' / 'config.json').read_text())
+    assert (saved['max_rows'], saved['max_age']) == (20, '30d')
+    assert 'max_bytes' not in saved
+
+
+def test_usage_agent_offline(tmp_path, monkeypatch):
+    agent = _usage_agent(tmp_path, multi_writer=True, max_rows=2, host='http://127.0.0.1:9',
+                         refresh_route='/auth/token', client_id='client',
+                         client_secret='secret', refresh_token='token')
+    agent.create_cache()
+    agent.segment_interval = 1e-3
+    cycles = []
+
+    def sleep(seconds):
+        cycles.append(seconds)
+        if len(cycles) > 3:
+            config.ConfigStore(tmp_path / 'config.json').save(dict(agent.config,
+                                                                   collect=False))
+        else:
+            agent.log_many((None, 'import') for _ in range(5))
+            # seal the segment
+            real_sleep(0.01)
+
+    real_sleep = time.sleep
+    monkeypatch.setattr(usage.time, 'sleep', sleep)
+    # endpoint unreachable over several cycles, retention still bounds the cache
+    agent.recurring_send(start=datetime.datetime(2000, 1, 1), frequency='1s')
+
+    with sqlite3.connect(str(tmp_path / 'main.db')) as conn:
+        assert conn.execute('SELECT count(*) FROM event').fetchone()[0] == 2
+    assert list((tmp_path / 'segments').iterdir()) == []
+    assert metrics.load(db_path=str(tmp_path / 'main.db'))[
+        'upload_cycle_errors_total'] == ('counter', 3)
+
+
+def test_usage_agent_metrics(tmp_path, monkeypatch):
+    agent = _usage_agent(tmp_path, prometheus=True)
+    with sqlite3.connect(str(tmp_path / 'main.db')) as conn:
+        conn.execute('CREATE TABLE event(event_date datetime(3), event_type varchar(100))')
+    agent.log(event_type='import')
+    agent.log(event_type='import')
+    agent.flush_metrics()
+    agent.log(event_type='import')
+    agent_metrics = agent.show_metrics()
+
+    assert agent_metrics['events_logged_total'] == ('counter', 3)
+    assert agent_metrics['log_seconds_count'] == ('counter', 3)
+    assert agent_metrics['log_seconds_max'][0] == 'max'
+    assert ('# TYPE otumat_usage_events_logged_total counter\n'
+            'otumat_usage_events_logged_total 3.0\n') in (
+                tmp_path / 'metrics.prom').read_text()
+    # long-running hosts flush periodically while logging
+    monkeypatch.setattr(usage, 'METRICS_FLUSH_INTERVAL', 0)
+    agent.log(event_type='import')
+
+    assert agent.metrics.values == {}
+    assert metrics.load(db_path=str(tmp_path / 'main.db'))['events_logged_total'] == (
+        'counter', 4)
+
+
+def test_usage_agent_send(tmp_path):
+    with MockIngestServer(expire_every=2) as server:
+        agent = _usage_agent(tmp_path, host=server.url, event_route=server.event_route,
+                             refresh_route=server.refresh_route, install_id=server.install_id,
+                             client_id=server.client_id, client_secret=server.client_secret,
+                             refresh_token=server.refresh_token, access_token=None)
+        agent.save_config()
+        agent.create_cache()
+        for event_type in ('import', 'fetch', 'import'):
+            agent.log(event_type=event_type)
+        agent.send()
+        agent.log(event_type='insert')
+        agent.send()
+
+    assert agent.show_logs() == []
+    assert server.stats['events_received'] == 4
+    assert server.stats['expired'] == 1
+    assert agent.metrics.values['send_retries_total'] == ('counter', 1)
+    assert agent.metrics.values['sends_total'] == ('counter', 2)
+    assert agent.metrics.values['send_seconds_count'] == ('counter', 2)
+
+
+def test_usage_agent_log_many(tmp_path):
+    agent = _usage_agent(tmp_path)
+    with sqlite3.connect(str(tmp_path / 'main.db')) as conn:
+        # cache created before attributes were supported
+        conn.execute('CREATE TABLE event(event_date datetime(3), event_type varchar(100))')
+    count = agent.log_many((e for e in [
+        (datetime.datetime(2022, 1, 1), 'import'),
+        (datetime.datetime(2022, 1, 1, tzinfo=datetime.timezone.utc).timestamp(), 'fetch',
+         dict(rows=10))]))
+    count += agent.log_many(timestamps=['2022-01-02T00:00:00', None],
+                            event_types=['insert', 'delete'],
+                            attributes=[None, dict(table='session')])
+
+    assert count == 4
+    assert agent.show_logs()[:3] == [
+        ('2022-01-01 00:00:00.000000', 'import', None),
+        ('2022-01-01 00:00:00.000000', 'fetch', '{"rows":10}'),
+        ('2022-01-02 00:00:00.000000', 'insert', None)]
+    assert agent.show_logs()[3][1:] == ('delete', '{"table":"session"}')
+    assert agent.metrics.values['events_logged_total'] == ('counter', 4)
+    with pytest.raises(ValueError):
+        agent.log_many([('01/03/2022', 'import')])
+    # backdated events are evicted first even though they were logged last
+    agent.log_many([('2021-12-31 00:00:00+00:00', 'import')])
+    agent.config = dict(agent.config, max_rows=4)
+    agent.enforce_retention()
+
+    assert [r[1] for r in agent.show_logs()] == ['import', 'fetch', 'insert', 'delete']
+
+
+def test_config_store(tmp_path):
+    path = tmp_path / 'config.json'
+    path.write_text(json.dumps(dict(collect=True)))
+    store = config.ConfigStore(path)
+    changes = []
+    store.subscribe(changes.append)
+    first = store.load()
+
+    assert store.load() is first
+    store.save(dict(collect=True, access_token='a'))
+    assert store.load() == dict(collect=True, access_token='a')
+    # another process replaces the file
+    config.ConfigStore(path).save(dict(collect=False))
+    assert store.load() == dict(collect=False)
+    assert changes == [dict(collect=True, access_token='a'), dict(collect=False)]
+    store.unsubscribe(changes.append)
+    store.save(dict(collect=True))
+    assert len(changes) == 2
+    # failed writes leave no temporary files behind
+    with pytest.raises(TypeError):
+        store.save(dict(collect=object()))
+    # torn write by an older in-place writer keeps the last consistent copy
+    path.write_text('{"collect": fa')
+    assert store.load() == dict(collect=True)
+    assert [p.name for p in tmp_path.iterdir()] == ['config.json']
+
+
+def test_probe_environment_failure(tmp_path, monkeypatch):
+    def conda_timeout(**kwargs):
+        raise usage.subprocess.TimeoutExpired(['conda', '--version'], 1)
+
+    monkeypatch.setattr(usage.appdirs, 'user_cache_dir', lambda *args: str(tmp_path))
+    monkeypatch.setattr(usage, '_probe_conda_version', conda_timeout)
+    monkeypatch.setattr(usage, '_probe_geo_data', lambda **kwargs: dict(
+        city='Houston', region='Texas', country='US', timezone='America/Chicago'))
+    probe = usage._probe_environment(package_name='watchdog', timeout=1)
+
+    assert probe['pkg_manager'] is None
+    assert not (tmp_path / 'probe.json').exists()
+    # a hung probe, e.g. on DNS resolution, is abandoned after the timeout
+    resolved = threading.Event()
+    monkeypatch.setattr(usage, '_probe_conda_version', lambda **kwargs: None)
+    monkeypatch.setattr(usage, '_probe_geo_data', lambda **kwargs: resolved.wait(10))
+    start = time.perf_counter()
+    probe = usage._probe_environment(package_name='watchdog', timeout=0.1)
+    resolved.set()
+
+    assert time.perf_counter() - start < 5
+    assert (probe['pkg_manager'], probe['location']) == ('pip', None)
+    assert not (tmp_path / 'probe.json').exists()
+
+
+def test_stats_command(tmp_path, monkeypatch, capsys):
+    monkeypatch.setattr(command_line.appdirs, 'user_data_dir', lambda *args: str(tmp_path))
+    with pytest.raises(SystemExit):
+        command_line.otumat(['stats', '-a', 'a', '-d', 'd', '-p', 'pkg'])
+
+    assert 'not installed' in capsys.readouterr().out
+    assert list(tmp_path.iterdir()) == []
+    agent = _usage_agent(tmp_path / 'usage')
+    agent.metrics.increment('events_logged_total', 2)
+    agent.flush_metrics()
+    with pytest.raises(SystemExit):
+        command_line.otumat(['stats', '-a', 'a', '-d', 'd', '-p', 'pkg', '--prometheus'])
+
+    assert 'otumat_usage_events_logged_total 2' in capsys.readouterr().out
+
+
+def test_benchmark_modes(tmp_path, monkeypatch):
+    monkeypatch.setattr(usage, 'DISABLE_USAGE_TRACKING_PACKAGES', ['otumat-benchmark'])
+    monkeypatch.setattr(benchmark.appdirs, 'user_data_dir',
+                        lambda *args: str(tmp_path / args[0]))
+    for kwargs in (dict(), dict(bulk=100), dict(bulk=30, multi_writer=True)):
+        results = benchmark.run(events=250, send_every=100, **kwargs)
+
+        assert results['events_uploaded'] == 250
+        assert results['sends'] == 3
+    assert list(tmp_path.iterdir()) == []
+    # every upload's token expires once and is renewed
+    results = benchmark.run(events=10, send_every=5, expire_every=1)
+
+    assert (results['events_uploaded'], results['token_expired_retries']) == (10, 2)
+    with pytest.raises(Exception):
+        benchmark.run(send_every=0)
+    with pytest.raises(SystemExit):
+        command_line.otumat(['benchmark', '-n', '-1'])
+
+
+def test_usage_agent_config_changes(tmp_path):
+    agent = _usage_agent(tmp_path)
+    agent.create_cache()
+    agent.log(event_type='import')
+    # another process opts out
+    config.ConfigStore(tmp_path / 'config.json').save(dict(agent.config, collect=False))
+    agent.log(event_type='import')
+
+    assert agent.config['collect'] is False
+    assert agent.metrics.values['events_logged_total'] == ('counter', 1)
+    # subscriptions and metrics do not keep agents alive
+    agent_ref = weakref.ref(agent)
+    del agent
+    gc.collect()
+    assert agent_ref() is None
+
+
+def test_usage_agent_refresh_opt_out(tmp_path):
+    with MockIngestServer() as server:
+        agent = _usage_agent(tmp_path, host=server.url, event_route=server.event_route,
+                             refresh_route=server.refresh_route, install_id=server.install_id,
+                             client_id=server.client_id, client_secret=server.client_secret,
+                             refresh_token=server.refresh_token, access_token=None)
+        agent.create_cache()
+        agent.log(event_type='import')
+        issue_token = server.issue_token
+
+        def opt_out():
+            # another process opts out while the token request is in flight
+            config.ConfigStore(tmp_path / 'config.json').save(dict(agent.config,
+                                                                   collect=False))
+            return issue_token()
+
+        server.issue_token = opt_out
+        agent.send()
+
+    saved = json.loads((tmp_path / 'config.json').read_text())
+    assert saved['collect'] is False
+    assert saved['refresh_token'] == server.refresh_token
+    assert server.stats['attempts'] == 0